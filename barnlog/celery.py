@@ -1,13 +1,16 @@
 import logging
-import logging.config
 from typing import Any
 
 from celery import Task, signals, states
 
+from barnlog.logging import LogContext, get_trace, inject_traceparent, log_context, logging_config
+from barnlog.tracing import TRACEPARENT_HEADER, format_traceparent, start_trace
+
 
 def setup_celery_logging(setup_logging: bool = True) -> None:
     if setup_logging:
         signals.setup_logging.connect(on_setup_logging, weak=False)
+    signals.before_task_publish.connect(on_before_task_publish, weak=False)
     signals.task_prerun.connect(on_task_prerun, weak=False)
     signals.task_postrun.connect(on_task_postrun, weak=False)
 
@@ -15,7 +18,7 @@ def setup_celery_logging(setup_logging: bool = True) -> None:
 def on_setup_logging(**kwargs):
     try:
         from django.conf import settings
-        logging.config.dictConfig(settings.LOGGING)
+        logging_config(settings.LOGGING)
     except ImportError:
         pass
 
@@ -23,7 +26,21 @@ def on_setup_logging(**kwargs):
 logger = logging.getLogger(__name__)
 
 
+def on_before_task_publish(headers: dict | None = None, **kwargs):
+    if headers is not None:
+        inject_traceparent(headers)
+
+
 def on_task_prerun(task_id: Any, task: Task, **kwargs):
+    traceparent = getattr(task.request, TRACEPARENT_HEADER, None)
+    if traceparent is None:
+        # eager tasks are not published, they continue the trace of the caller
+        trace = get_trace()
+        if trace is not None:
+            traceparent = format_traceparent(*trace)
+    # eager tasks run inside the caller context, postrun restores it
+    context = LogContext(str(task_id), start_trace(traceparent))
+    task.request.barnlog_log_context_token = log_context.set(context)
     logger.info(
         "Task %r started", task_id,
         extra={
@@ -55,3 +72,6 @@ def on_task_postrun(task_id: Any, task: Task, **kwargs):
             },
         },
     )
+    token = getattr(task.request, "barnlog_log_context_token", None)
+    if token is not None:
+        log_context.reset(token)
@@ -5,6 +5,9 @@ import platform
 import threading
 import time
 
+from barnlog.logging import LogContext, log_context
+from barnlog.tracing import start_trace
+
 logger = logging.getLogger(__name__)
 
 
@@ -15,6 +18,7 @@ def request_id_middleware(get_response):
     # from django.utils.crypto import get_random_string
 
     REQUEST_ID_HEADER = getattr(settings, "REQUEST_ID_HEADER", "HTTP_X_REQUEST_ID")
+    TRACEPARENT_HEADER = getattr(settings, "TRACEPARENT_HEADER", "HTTP_TRACEPARENT")
 
     hostname = platform.node()
     # prefix = get_random_string(8)
@@ -40,7 +44,12 @@ def request_id_middleware(get_response):
     def middleware(request):
         request_id = get_request_id(request)
         request.request_id = request_id
-        return get_response(request)
+        traceparent = request.META.get(TRACEPARENT_HEADER) if TRACEPARENT_HEADER else None
+        token = log_context.set(LogContext(request_id, start_trace(traceparent)))
+        try:
+            return get_response(request)
+        finally:
+            log_context.reset(token)
 
     return middleware
 
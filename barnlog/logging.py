@@ -1,4 +1,6 @@
 import base64
+import collections
+import copy
 import json
 import logging
 import logging.config
@@ -6,8 +8,16 @@ import logging.handlers
 import os
 import platform
 import sys
+import threading
+import time
+import traceback
+import weakref
+from contextvars import ContextVar
 from functools import cache
-from typing import Any
+from typing import Any, MutableMapping
+
+from barnlog.profiler import profiler
+from barnlog.tracing import TRACEPARENT_HEADER, Trace, format_traceparent, get_otel_trace
 
 
 def get_app_name() -> str:
@@ -23,8 +33,75 @@ def get_hostname() -> str:
     return platform.node()
 
 
+class DictConfigurator(logging.config.DictConfigurator):
+    # configures the sinks of a FanoutHandler before it, the fan-out handler keeps them
+    # alive even if no logger uses them
+    def configure_handler(self, config):
+        if isinstance(config, logging.Handler):
+            # already configured as a sink
+            return config
+        klass = config.get("class")
+        if isinstance(klass, str):
+            klass = self.resolve(klass)
+        if isinstance(klass, type) and issubclass(klass, FanoutHandler):
+            handlers = self.config["handlers"]
+            for name in config.get("handlers", ()):
+                if not isinstance(handlers[name], logging.Handler):
+                    handler = self.configure_handler(handlers[name])
+                    handler.name = name
+                    handlers[name] = handler
+        return super().configure_handler(config)
+
+
+def logging_config(config: dict) -> None:
+    DictConfigurator(config).configure()
+
+
+class LogContext:
+    # a request or a task, handlers keep their per context state in buffers
+    __slots__ = ("id", "trace", "buffers")
+
+    def __init__(self, id: str, trace: Trace | None = None) -> None:
+        self.id = id
+        self.trace = trace
+        self.buffers: dict[logging.Handler, Any] = {}
+
+
+log_context: ContextVar[LogContext | None] = ContextVar("barnlog_log_context", default=None)
+
+
+def get_trace() -> Trace | None:
+    # an active OpenTelemetry span wins over the trace of the request or task
+    trace = get_otel_trace()
+    if trace is None:
+        context = log_context.get()
+        if context is not None:
+            trace = context.trace
+    return trace
+
+
+def inject_traceparent(headers: MutableMapping[str, Any]) -> None:
+    if TRACEPARENT_HEADER in headers:
+        return
+    trace = get_trace()
+    if trace is not None:
+        headers[TRACEPARENT_HEADER] = format_traceparent(*trace)
+
+
 class JsonFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
+        # FanoutHandler passes the output shared by its sinks with this formatter
+        shared = record.__dict__.get("barnlog_formatted")
+        if shared is not None and shared[0] is self:
+            data = shared[1]
+        else:
+            data = self._format(record)
+        if profiler.enabled:
+            # read by ProfilingHandler
+            record.barnlog_size = len(data.encode("utf-8"))
+        return data
+
+    def _format(self, record: logging.LogRecord) -> str:
         super().format(record)
         return json.dumps(self.serialize(record), ensure_ascii=False, sort_keys=True)
 
@@ -64,6 +141,11 @@ class JsonFormatter(logging.Formatter):
             "labels.app_version": app_version,
         }
 
+        trace = get_trace()
+        if trace is not None:
+            res["trace.id"] = trace[0]
+            res["span.id"] = trace[1]
+
         if record.exc_info:
             exc_text = record.exc_text
             if not record.exc_text:
@@ -151,6 +233,99 @@ class HTTPHandler(logging.handlers.HTTPHandler):
             self.handleError(record)
 
 
+class FanoutHandler(logging.Handler):
+    # Passes records to several sinks with their own levels and filters, a failing sink
+    # doesn't affect the others. Sinks without filters that use the same JsonFormatter
+    # share one serialization of the record.
+    # Sinks are handler instances or handler names, the names not configured yet are
+    # resolved on first use. With dictConfig set LOGGING_CONFIG = "barnlog.logging.logging_config"
+    # (or call logging_config()): the plain dictConfig doesn't keep handlers that no logger
+    # uses, so sinks configured after the fan-out handler would be lost.
+    def __init__(self, handlers=(), level=logging.NOTSET):
+        super().__init__(level)
+        self.handlers: list[logging.Handler | str] = [
+            logging.getHandlerByName(handler) or handler if isinstance(handler, str) else handler
+            for handler in handlers
+        ]
+        self.resolved = not any(isinstance(handler, str) for handler in self.handlers)
+
+    def get_handlers(self) -> list[logging.Handler]:
+        if not self.resolved:
+            for pos, handler in enumerate(self.handlers):
+                if isinstance(handler, str):
+                    resolved = logging.getHandlerByName(handler)
+                    if resolved is None:
+                        raise ValueError(f"handler {handler!r} is not configured")
+                    self.handlers[pos] = resolved
+            self.resolved = True
+        return self.handlers
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            handlers = self.get_handlers()
+        except ValueError:
+            self.handleError(record)
+            return
+        formatted = {}
+        for handler in handlers:
+            if record.levelno < handler.level:
+                continue
+            formatter = handler.formatter
+            try:
+                # filters can change the record, such sinks format it by themselves
+                if handler.filters or not isinstance(formatter, JsonFormatter):
+                    handler.handle(record)
+                    continue
+                data = formatted.get(formatter)
+                if data is None:
+                    data = formatted[formatter] = formatter.format(record)
+                record.barnlog_formatted = (formatter, data)
+                try:
+                    handler.handle(record)
+                finally:
+                    del record.barnlog_formatted
+            except Exception:
+                handler.handleError(record)
+
+    def flush(self) -> None:
+        try:
+            handlers = self.get_handlers()
+        except ValueError:
+            self.handleError(None)
+            return
+        for handler in handlers:
+            try:
+                handler.flush()
+            except Exception:
+                handler.handleError(None)
+
+
+class ProfilingHandler(logging.handlers.MemoryHandler):
+    # Attributes the format and emit time of the target handler to the record call site,
+    # the size is known when the target uses JsonFormatter.
+    def __init__(self, target=None):
+        super().__init__(0, target=target, flushOnClose=False)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.target is None or record.levelno < self.target.level:
+            return
+        if not profiler.enabled:
+            self.target.handle(record)
+            return
+        record.__dict__.pop("barnlog_size", None)
+        start = time.perf_counter()
+        rv = self.target.handle(record)
+        seconds = time.perf_counter() - start
+        size = record.__dict__.pop("barnlog_size", 0)
+        # the record is rejected by the target filters
+        if rv:
+            profiler.add(record, size, seconds)
+
+    def flush(self) -> None:
+        if self.target is not None:
+            self.target.flush()
+
+
 class QueueHandler(logging.handlers.QueueHandler):
     def enqueue(self, record: logging.LogRecord) -> None:
         self.queue.put(record)
@@ -163,3 +338,316 @@ class QueueListener(logging.handlers.QueueListener):
     def start(self) -> None:
         if not self._thread or not self._thread.is_alive():
             return super().start()
+
+
+class RingBuffer:
+    __slots__ = ("items", "pos", "size")
+
+    def __init__(self, capacity: int) -> None:
+        self.items: list[logging.LogRecord | None] = [None] * capacity
+        self.pos = 0
+        self.size = 0
+
+    def append(self, record: logging.LogRecord) -> None:
+        capacity = len(self.items)
+        self.items[self.pos] = record
+        self.pos = (self.pos + 1) % capacity
+        if self.size < capacity:
+            self.size += 1
+
+    def drain(self) -> list[logging.LogRecord]:
+        capacity = len(self.items)
+        start = (self.pos - self.size) % capacity
+        records = [self.items[(start + i) % capacity] for i in range(self.size)]
+        self.items[:] = [None] * capacity
+        self.pos = 0
+        self.size = 0
+        return records
+
+
+class RingBufferHandler(logging.handlers.MemoryHandler):
+    # Keeps the last `capacity` records below `flushLevel` for the current LogContext
+    # and passes them to the target only when a record at `flushLevel` or above arrives.
+    # Records outside of any context share a single ring. flush() doesn't release the
+    # trail, logging.shutdown() and other callers must not ship it without an error.
+    def __init__(self, capacity=100, flushLevel=logging.ERROR, target=None):
+        capacity = int(capacity)
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        super().__init__(capacity, flushLevel=flushLevel, target=target,
+                         flushOnClose=False)
+        self.ring = RingBuffer(self.capacity)
+
+    def get_ring(self) -> RingBuffer:
+        context = log_context.get()
+        if context is None:
+            return self.ring
+        ring = context.buffers.get(self)
+        if ring is None:
+            ring = context.buffers[self] = RingBuffer(self.capacity)
+        return ring
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the same as logging.handlers.QueueHandler, args can be changed after the call
+        record = copy.copy(record)
+        record.__dict__.pop("barnlog_formatted", None)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        # the buffered record must not keep the traceback (frames and their locals)
+        # and the caller's objects alive
+        formatter = self.formatter or logging.Formatter()
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = (record.exc_info[0], None, None)
+        if record.stack_info:
+            record.stack_info = formatter.formatStack(record.stack_info)
+        extra = getattr(record, "extra", None)
+        if isinstance(extra, dict):
+            record.extra = dict(extra)
+        return record
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.levelno >= self.flushLevel:
+            self._release()
+            if self.target:
+                self.target.handle(record)
+        else:
+            self.get_ring().append(self.prepare(record))
+
+    def _release(self) -> None:
+        records = self.get_ring().drain()
+        if self.target:
+            for record in records:
+                self.target.handle(record)
+
+    def flush(self) -> None:
+        pass
+
+
+class FileHandler(logging.Handler):
+    # NDJSON file sink for a sidecar that tails files: records are buffered and written
+    # with one os.write when the buffer is full or every flush_interval seconds.
+    # fsync: "never" - leave it to the OS, "flush" - after every write, "rotate" - before
+    # rotation and close.
+    # multiprocess: several processes (prefork workers) append to the same file, every write
+    # contains whole records and O_APPEND keeps them from interleaving; rotation is left to
+    # an external tool and the file is reopened when it is replaced.
+    fsync_policies = ("never", "flush", "rotate")
+    # full buffers waiting for a write before an emitter waits for the write
+    max_pending = 4
+
+    def __init__(self, filename, buffer_size=65536, flush_interval=1.0, fsync="never",
+                 max_bytes=0, rotate_interval=0, backup_count=0, multiprocess=False,
+                 level=logging.NOTSET):
+        super().__init__(level)
+        if fsync not in self.fsync_policies:
+            raise ValueError(f"fsync must be one of {self.fsync_policies}")
+        if multiprocess and (max_bytes or rotate_interval):
+            raise ValueError("rotation is not supported with multiprocess writes")
+        self.filename = os.path.abspath(os.fspath(filename))
+        self.buffer_size = int(buffer_size)
+        self.flush_interval = float(flush_interval)
+        self.fsync = fsync
+        self.max_bytes = int(max_bytes)
+        self.rotate_interval = float(rotate_interval)
+        self.backup_count = int(backup_count)
+        self.multiprocess = multiprocess
+        self.buffer: list[bytes] = []
+        self.buffered = 0
+        self.fd = None
+        self.size = 0
+        self.rotate_at = 0.0
+        # The handler lock guards only the buffer, handle() doesn't hold it around emit().
+        # Full buffers are queued to pending and written under _io_lock by whoever gets it,
+        # the other threads keep buffering records while a write, fsync or rotation runs.
+        self.pending: collections.deque[bytes] = collections.deque()
+        self._io_lock = threading.Lock()
+        self.open()
+        self._stop = threading.Event()
+        self._thread = None
+        self.start()
+        _file_handlers.add(self)
+
+    def open(self) -> None:
+        self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        if self.rotate_interval:
+            self.rotate_at = time.time() + self.rotate_interval
+
+    def start(self) -> None:
+        if self.flush_interval > 0:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._flusher, name="barnlog-file-flusher",
+                                            daemon=True)
+            self._thread.start()
+
+    def _flusher(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            # close() can be called with the handler lock held (logging.shutdown),
+            # the flusher must not wait for it
+            if not self.lock.acquire(blocking=False):
+                continue
+            try:
+                self._swap_buffer()
+            finally:
+                self.lock.release()
+            try:
+                self._write_pending()
+            except Exception:
+                self._report_error()
+
+    def handle(self, record: logging.LogRecord) -> logging.LogRecord | bool:
+        # the same as logging.Handler.handle without the handler lock around emit()
+        rv = self.filter(record)
+        if isinstance(rv, logging.LogRecord):
+            record = rv
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            data = (self.format(record) + "\n").encode("utf-8")
+            with self.lock:
+                self.buffer.append(data)
+                self.buffered += len(data)
+                if self.buffered < self.buffer_size:
+                    return
+                self._swap_buffer()
+            # another thread is writing and will write this buffer too,
+            # wait for it only when the writes can't keep up
+            if len(self.pending) > self.max_pending:
+                self._write_pending()
+            elif self._io_lock.acquire(blocking=False):
+                self._write_pending(locked=True)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self) -> None:
+        with self.lock:
+            self._swap_buffer()
+        self._write_pending()
+
+    def _swap_buffer(self) -> None:
+        # called with the handler lock held
+        if self.buffer:
+            self.pending.append(b"".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def _write_pending(self, locked: bool = False) -> None:
+        if not locked:
+            self._io_lock.acquire()
+        while True:
+            try:
+                while self.pending:
+                    self._write(self.pending.popleft())
+            finally:
+                self._io_lock.release()
+            # a buffer queued by a thread which didn't get the lock
+            if not self.pending or not self._io_lock.acquire(blocking=False):
+                return
+
+    def _write(self, data: bytes) -> None:
+        # called with _io_lock held
+        if self.fd is None:
+            # the same as logging.FileHandler, the file is opened again after close()
+            self.open()
+        if self.multiprocess:
+            self._reopen_if_replaced()
+        elif self.should_rotate(len(data)):
+            try:
+                self.rotate()
+            except Exception:
+                # rotate() reopens the file, the data is written to it anyway
+                self._report_error()
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        self.size += len(data)
+        if self.fsync == "flush":
+            os.fsync(self.fd)
+
+    def _report_error(self) -> None:
+        if logging.raiseExceptions:
+            traceback.print_exc(file=sys.stderr)
+
+    def _reopen_if_replaced(self) -> None:
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            st = None
+        fst = os.fstat(self.fd)
+        if st is None or (st.st_dev, st.st_ino) != (fst.st_dev, fst.st_ino):
+            os.close(self.fd)
+            self.fd = None
+            self.open()
+
+    def should_rotate(self, size: int) -> bool:
+        if not self.backup_count:
+            return False
+        if self.max_bytes and self.size and self.size + size > self.max_bytes:
+            return True
+        return bool(self.rotate_interval) and time.time() >= self.rotate_at
+
+    def rotate(self) -> None:
+        # renames only, runs under _io_lock and doesn't block the emitters
+        try:
+            if self.fsync != "never":
+                os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+            for i in range(self.backup_count - 1, 0, -1):
+                src = f"{self.filename}.{i}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.filename}.{i + 1}")
+            if os.path.exists(self.filename):
+                os.replace(self.filename, f"{self.filename}.1")
+        finally:
+            if self.fd is None:
+                self.open()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        with self.lock:
+            try:
+                self._swap_buffer()
+                with self._io_lock:
+                    while self.pending:
+                        self._write(self.pending.popleft())
+                    if self.fd is not None:
+                        try:
+                            if self.fsync != "never":
+                                os.fsync(self.fd)
+                        finally:
+                            os.close(self.fd)
+                            self.fd = None
+            finally:
+                super().close()
+
+    def _after_fork(self) -> None:
+        # the parent writes its own buffers, the flusher thread doesn't survive fork
+        self.buffer = []
+        self.buffered = 0
+        self.pending.clear()
+        self._io_lock = threading.Lock()
+        if self.fd is not None:
+            self.start()
+
+
+_file_handlers = weakref.WeakSet()
+
+
+def _after_fork_in_child() -> None:
+    for handler in list(_file_handlers):
+        handler._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
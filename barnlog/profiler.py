@@ -0,0 +1,107 @@
+import logging
+import os
+import signal
+import sys
+import threading
+from typing import Any, TextIO
+
+# Per call site logging cost attribution.
+# Wrap the handlers with barnlog.logging.ProfilingHandler, enable with BARNLOG_PROFILE=1
+# or profiler.enable(), then dump a report with profiler.dump() or by sending the signal
+# installed by install_signal_handler()
+#   kill -USR1 <pid>
+
+CallSite = tuple[str, str, int]
+
+
+class CallSiteStats:
+    __slots__ = ("count", "bytes", "seconds")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+
+class LogProfiler:
+    sort_keys = ("count", "bytes", "seconds")
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self._stats: dict[CallSite, CallSiteStats] = {}
+        self._lock = threading.Lock()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats = {}
+
+    def add(self, record: logging.LogRecord, size: int, seconds: float) -> None:
+        key = (record.name, record.pathname, record.lineno)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = CallSiteStats()
+            stats.count += 1
+            stats.bytes += size
+            stats.seconds += seconds
+
+    def report(self, limit: int | None = 20, sort: str = "bytes") -> list[dict[str, Any]]:
+        if sort not in self.sort_keys:
+            raise ValueError(f"sort must be one of {self.sort_keys}")
+        with self._lock:
+            rows = [
+                {
+                    "log.logger": name,
+                    "log.origin.file.name": pathname,
+                    "log.origin.file.line": lineno,
+                    "count": stats.count,
+                    "bytes": stats.bytes,
+                    "seconds": stats.seconds,
+                }
+                for (name, pathname, lineno), stats in self._stats.items()
+            ]
+        rows.sort(key=lambda row: row[sort], reverse=True)
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+    def dump(self, stream: TextIO | None = None, limit: int | None = 20, sort: str = "bytes") -> None:
+        stream = stream or sys.stderr
+        stream.write(f"{'count':>10} {'bytes':>12} {'seconds':>10}  call site\n")
+        for row in self.report(limit=limit, sort=sort):
+            stream.write(
+                f"{row['count']:>10} {row['bytes']:>12} {row['seconds']:>10.4f}  "
+                f"{row['log.logger']} {row['log.origin.file.name']}:{row['log.origin.file.line']}\n"
+            )
+        stream.flush()
+
+
+profiler = LogProfiler(enabled=os.getenv("BARNLOG_PROFILE", "") not in ("", "0"))
+
+
+def install_signal_handler(signum: int | None = None, limit: int | None = 20,
+                           sort: str = "bytes", stream: TextIO | None = None) -> Any:
+    # SIGUSR1 is used by gunicorn (reopen log files) and celery (thread dump),
+    # the previous handler is still called
+    if signum is None:
+        signum = signal.SIGUSR1
+
+    def on_signal(signum, frame):
+        # the signal can interrupt the main thread inside profiler.add() holding the lock
+        threading.Thread(
+            target=profiler.dump,
+            kwargs={"stream": stream, "limit": limit, "sort": sort},
+            name="barnlog-profiler-dump",
+            daemon=True,
+        ).start()
+        if callable(previous):
+            previous(signum, frame)
+
+    previous = signal.signal(signum, on_signal)
+    return previous
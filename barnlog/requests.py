@@ -2,6 +2,8 @@ import logging
 
 import requests
 
+from barnlog.logging import inject_traceparent
+
 logger = logging.getLogger(__name__)
 
 # from barnlog.requests import LoggedSession
@@ -16,6 +18,7 @@ class LoggedSession(requests.Session):
         self.with_body = with_body
 
     def send(self, request: requests.PreparedRequest, **kwargs):
+        inject_traceparent(request.headers)
         basic = {
             "url.full": request.url,
             "http.request.method": request.method,
@@ -0,0 +1,63 @@
+import os
+import re
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+# W3C Trace Context, https://www.w3.org/TR/trace-context/#traceparent-header
+TRACEPARENT_HEADER = "traceparent"
+TRACEPARENT_RE = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+INVALID_TRACE_ID = "0" * 32
+INVALID_SPAN_ID = "0" * 16
+
+Trace = tuple[str, str, str]
+
+
+def new_trace_id() -> str:
+    return os.urandom(16).hex()
+
+
+def new_span_id() -> str:
+    return os.urandom(8).hex()
+
+
+def parse_traceparent(value: str | None) -> Trace | None:
+    if not value:
+        return None
+    match = TRACEPARENT_RE.match(value.strip().lower())
+    if not match:
+        return None
+    version, trace_id, span_id, flags = match.groups()
+    if version == "ff" or trace_id == INVALID_TRACE_ID or span_id == INVALID_SPAN_ID:
+        return None
+    return trace_id, span_id, flags
+
+
+def format_traceparent(trace_id: str, span_id: str, flags: str = "01") -> str:
+    return f"00-{trace_id}-{span_id}-{flags}"
+
+
+def get_otel_trace() -> Trace | None:
+    if otel_trace is None:
+        return None
+    span_context = otel_trace.get_current_span().get_span_context()
+    if not span_context.is_valid:
+        return None
+    return (
+        format(span_context.trace_id, "032x"),
+        format(span_context.span_id, "016x"),
+        format(span_context.trace_flags, "02x"),
+    )
+
+
+def start_trace(traceparent: str | None = None) -> Trace:
+    trace = get_otel_trace()
+    if trace is not None:
+        return trace
+    parent = parse_traceparent(traceparent)
+    if parent is None:
+        return new_trace_id(), new_span_id(), "01"
+    trace_id, _, flags = parent
+    return trace_id, new_span_id(), flags
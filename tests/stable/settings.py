@@ -13,7 +13,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 import os
 from pathlib import Path
 
-# LOGGING_CONFIG = "barnlog.logging.logging_config"
+LOGGING_CONFIG = "barnlog.logging.logging_config"
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
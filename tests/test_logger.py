@@ -1,7 +1,32 @@
+import copy
+import io
+import json
 import logging
+import signal
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
 import pytest
+from django.http import HttpResponse
 
+from barnlog.celery import on_before_task_publish, on_task_postrun, on_task_prerun
+from barnlog.django import request_id_middleware
+from barnlog.logging import (FanoutHandler, FileHandler, JsonFormatter, LogContext, ProfilingHandler,
+                             RingBufferHandler, get_trace, inject_traceparent, log_context, logging_config)
+from barnlog.profiler import install_signal_handler, profiler
 from barnlog.requests import LoggedSession
+from barnlog.tracing import format_traceparent, parse_traceparent, start_trace
+
+
+class CollectHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
 
 
 @pytest.mark.django_db(transaction=True)
@@ -17,3 +42,333 @@ class TestWorker:
         requests_mock.get('https://httpbin.org/headers', text='data')
         s = LoggedSession()
         s.get('https://httpbin.org/headers', headers={'x-test2': 'true'})
+
+
+class TestProfiler:
+    @pytest.fixture
+    def enabled_profiler(self):
+        profiler.reset()
+        profiler.enable()
+        yield profiler
+        profiler.disable()
+        profiler.reset()
+
+    def test_report(self, enabled_profiler):
+        stream = logging.StreamHandler(io.StringIO())
+        stream.setFormatter(JsonFormatter())
+        collect = CollectHandler()
+        handler = FanoutHandler([ProfilingHandler(stream), ProfilingHandler(collect)])
+        for lineno in (10, 10, 20):
+            handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", lineno, "olala", None, None))
+
+        report = profiler.report(limit=1, sort="count")
+        assert len(report) == 1
+        assert report[0]["log.origin.file.line"] == 10
+        assert report[0]["count"] == 4
+        lines = stream.stream.getvalue().encode("utf-8").splitlines()
+        assert report[0]["bytes"] == len(lines[0]) + len(lines[1])
+
+    def test_filtered(self, enabled_profiler):
+        collect = CollectHandler()
+        collect.addFilter(lambda record: False)
+        handler = ProfilingHandler(collect)
+        handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", 10, "olala", None, None))
+        assert collect.records == []
+        assert profiler.report() == []
+
+    def test_signal(self, enabled_profiler, mocker):
+        profiler.add(logging.LogRecord("olala", logging.INFO, "olala.py", 10, "olala", None, None), 10, 0.001)
+        stream = io.StringIO()
+        chained = mocker.Mock()
+        original = signal.signal(signal.SIGUSR1, chained)
+        try:
+            install_signal_handler(stream=stream)
+            signal.raise_signal(signal.SIGUSR1)
+            for _ in range(100):
+                if "olala.py:10" in stream.getvalue():
+                    break
+                time.sleep(0.01)
+        finally:
+            signal.signal(signal.SIGUSR1, original)
+        assert "olala.py:10" in stream.getvalue()
+        assert chained.call_count == 1
+
+
+class TestRingBufferHandler:
+    def test_flush_on_error(self):
+        target = CollectHandler()
+        handler = RingBufferHandler(capacity=2, target=target)
+        log = logging.getLogger("olala.ring")
+        log.addHandler(handler)
+        log.setLevel(logging.DEBUG)
+        log.propagate = False
+        try:
+            token = log_context.set(LogContext("r1"))
+            try:
+                for i in range(3):
+                    log.debug("debug %s", i)
+                handler.flush()
+                assert target.records == []
+                log.error("error")
+            finally:
+                log_context.reset(token)
+            assert [r.getMessage() for r in target.records] == ["debug 1", "debug 2", "error"]
+
+            log.info("no context")
+            assert len(target.records) == 3
+        finally:
+            log.removeHandler(handler)
+
+
+    def test_prepare(self):
+        extra = {"labels.olala": "1"}
+        try:
+            raise RuntimeError("olala")
+        except RuntimeError:
+            record = logging.LogRecord("olala", logging.DEBUG, "olala.py", 10, "olala", None, sys.exc_info())
+        record.extra = extra
+        prepared = RingBufferHandler(capacity=1).prepare(record)
+        assert prepared.exc_info == (RuntimeError, None, None)
+        assert "RuntimeError: olala" in prepared.exc_text
+        assert prepared.extra == extra and prepared.extra is not extra
+        data = json.loads(JsonFormatter().format(prepared))
+        assert data["error.type"] == "builtins.RuntimeError"
+
+    def test_capacity(self):
+        with pytest.raises(ValueError):
+            RingBufferHandler(capacity=0)
+
+class TestTracing:
+    def test_traceparent(self):
+        traceparent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+        assert parse_traceparent(traceparent) == ("0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331", "01")
+        assert parse_traceparent("00-00000000000000000000000000000000-b7ad6b7169203331-01") is None
+        assert parse_traceparent("olala") is None
+
+        trace_id, span_id, flags = start_trace(traceparent)
+        assert trace_id == "0af7651916cd43dd8448eb211c80319c"
+        assert span_id != "b7ad6b7169203331"
+
+    def test_trace_fields(self):
+        record = logging.LogRecord("olala", logging.INFO, "olala.py", 10, "olala", None, None)
+        trace = start_trace()
+        token = log_context.set(LogContext("r1", trace))
+        try:
+            data = json.loads(JsonFormatter().format(record))
+            headers = {}
+            inject_traceparent(headers)
+        finally:
+            log_context.reset(token)
+        assert data["trace.id"] == trace[0]
+        assert data["span.id"] == trace[1]
+        assert headers["traceparent"] == f"00-{trace[0]}-{trace[1]}-01"
+        assert "trace.id" not in json.loads(JsonFormatter().format(record))
+
+    def test_requests(self, requests_mock):
+        requests_mock.get('https://httpbin.org/headers', text='data')
+        trace = start_trace()
+        token = log_context.set(LogContext("r1", trace))
+        try:
+            LoggedSession().get('https://httpbin.org/headers')
+        finally:
+            log_context.reset(token)
+        assert requests_mock.last_request.headers["traceparent"] == format_traceparent(*trace)
+
+    def test_request_id_middleware(self, rf):
+        traces = []
+
+        def view(request):
+            traces.append(get_trace())
+            return HttpResponse()
+
+        middleware = request_id_middleware(view)
+        middleware(rf.get("/", HTTP_TRACEPARENT="00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"))
+        assert traces[0][0] == "0af7651916cd43dd8448eb211c80319c"
+        assert traces[0][1] != "b7ad6b7169203331"
+        assert log_context.get() is None
+
+    def test_celery(self):
+        trace = start_trace()
+        token = log_context.set(LogContext("r1", trace))
+        try:
+            headers = {}
+            on_before_task_publish(headers=headers)
+            assert headers["traceparent"] == format_traceparent(*trace)
+
+            for request in (SimpleNamespace(traceparent=headers["traceparent"]), SimpleNamespace()):
+                task = SimpleNamespace(name="olala", request=request)
+                on_task_prerun(task_id="t1", task=task)
+                assert log_context.get().id == "t1"
+                assert get_trace()[0] == trace[0]
+                assert get_trace()[1] != trace[1]
+                on_task_postrun(task_id="t1", task=task, state="SUCCESS")
+                assert log_context.get().id == "r1"
+        finally:
+            log_context.reset(token)
+
+
+class TestFanoutHandler:
+    def test_fanout(self, mocker):
+        formatter = JsonFormatter()
+        serialize = mocker.spy(formatter, "serialize")
+
+        stream1, stream2 = io.StringIO(), io.StringIO()
+        console = logging.StreamHandler(stream1)
+        console.setFormatter(formatter)
+        errors = logging.StreamHandler(stream2)
+        errors.setFormatter(formatter)
+        errors.setLevel(logging.ERROR)
+        broken = CollectHandler()
+        broken.emit = mocker.Mock(side_effect=RuntimeError("olala"))
+        broken.handleError = mocker.Mock()
+
+        handler = FanoutHandler([broken, console, errors])
+        handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", 10, "info", None, None))
+        handler.handle(logging.LogRecord("olala", logging.ERROR, "olala.py", 20, "error", None, None))
+
+        assert serialize.call_count == 2
+        assert broken.handleError.call_count == 2
+        assert len(stream1.getvalue().splitlines()) == 2
+        assert len(stream2.getvalue().splitlines()) == 1
+
+    def test_filter_changes_record(self):
+        def add_label(record):
+            record = copy.copy(record)
+            record.extra = {"labels.sink": "second"}
+            return record
+
+        formatter = JsonFormatter()
+        first, second = io.StringIO(), io.StringIO()
+        handler1 = logging.StreamHandler(first)
+        handler1.setFormatter(formatter)
+        handler2 = logging.StreamHandler(second)
+        handler2.setFormatter(formatter)
+        handler2.addFilter(add_label)
+
+        handler = FanoutHandler([handler1, handler2])
+        handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", 10, "info", None, None))
+
+        assert "labels.sink" not in json.loads(first.getvalue())
+        assert json.loads(second.getvalue())["labels.sink"] == "second"
+
+    def test_lazy_sink(self):
+        handler = FanoutHandler(["olala.lazy"])
+        sink = CollectHandler()
+        sink.set_name("olala.lazy")
+        try:
+            handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", 10, "info", None, None))
+            assert handler.handlers == [sink]
+            assert len(sink.records) == 1
+        finally:
+            sink.close()
+
+    def test_logging_config(self):
+        logging_config({
+            "version": 1,
+            "disable_existing_loggers": False,
+            "formatters": {"json": {"class": "barnlog.logging.JsonFormatter"}},
+            "handlers": {
+                "fanout": {"class": "barnlog.logging.FanoutHandler", "handlers": ["olala"]},
+                "olala": {"class": "logging.StreamHandler", "formatter": "json", "level": "ERROR"},
+            },
+            "loggers": {"olala.fanout": {"handlers": ["fanout"], "propagate": False}},
+        })
+        log = logging.getLogger("olala.fanout")
+        handler = log.handlers[0]
+        try:
+            assert isinstance(handler, FanoutHandler)
+            assert handler.handlers == [logging.getHandlerByName("olala")]
+            assert handler.handlers[0].level == logging.ERROR
+        finally:
+            log.removeHandler(handler)
+            handler.handlers[0].close()
+            handler.close()
+
+
+class TestFileHandler:
+    def test_buffered_writes(self, tmp_path):
+        filename = tmp_path / "olala.log"
+        handler = FileHandler(filename, buffer_size=1 << 20, flush_interval=0)
+        handler.setFormatter(JsonFormatter())
+        try:
+            for lineno in range(3):
+                handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", lineno, "olala", None, None))
+            assert filename.read_text() == ""
+            handler.flush()
+            lines = filename.read_text().splitlines()
+            assert [json.loads(line)["log.origin.file.line"] for line in lines] == [0, 1, 2]
+        finally:
+            handler.close()
+
+    def test_rotation(self, tmp_path):
+        filename = tmp_path / "olala.log"
+        handler = FileHandler(filename, buffer_size=0, flush_interval=0, max_bytes=10, backup_count=2)
+        try:
+            for i in range(4):
+                handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", 10, "olala %s", (i,), None))
+        finally:
+            handler.close()
+        assert filename.read_text() == "olala 3\n"
+        assert (tmp_path / "olala.log.1").read_text() == "olala 2\n"
+        assert (tmp_path / "olala.log.2").read_text() == "olala 1\n"
+        assert not (tmp_path / "olala.log.3").exists()
+
+    def test_rotation_after_remove(self, tmp_path):
+        filename = tmp_path / "olala.log"
+        handler = FileHandler(filename, buffer_size=0, flush_interval=0, max_bytes=10, backup_count=1)
+        try:
+            handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", 10, "olala 0", None, None))
+            filename.unlink()
+            handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", 10, "olala 1", None, None))
+        finally:
+            handler.close()
+        assert filename.read_text() == "olala 1\n"
+
+    def test_rotation_failed(self, tmp_path, mocker):
+        filename = tmp_path / "olala.log"
+        handler = FileHandler(filename, buffer_size=0, flush_interval=0, max_bytes=10, backup_count=1)
+        try:
+            handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", 10, "olala 0", None, None))
+            mocker.patch("os.replace", side_effect=OSError("olala"))
+            handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", 10, "olala 1", None, None))
+        finally:
+            handler.close()
+        assert filename.read_text() == "olala 0\nolala 1\n"
+
+    def test_write_without_handler_lock(self, tmp_path, mocker):
+        handler = FileHandler(tmp_path / "olala.log", buffer_size=0, flush_interval=0)
+        locked = []
+
+        def check_lock(data):
+            def try_lock():
+                if handler.lock.acquire(blocking=False):
+                    handler.lock.release()
+                    locked.append(False)
+                else:
+                    locked.append(True)
+
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+            write(data)
+
+        write = handler._write
+        mocker.patch.object(handler, "_write", side_effect=check_lock)
+        try:
+            handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", 10, "olala", None, None))
+        finally:
+            handler.close()
+        assert locked == [False]
+        assert (tmp_path / "olala.log").read_text() == "olala\n"
+
+    def test_close_with_lock(self, tmp_path):
+        handler = FileHandler(tmp_path / "olala.log", flush_interval=0.001)
+        handler.handle(logging.LogRecord("olala", logging.INFO, "olala.py", 10, "olala", None, None))
+        # the same as logging.shutdown()
+        handler.acquire()
+        try:
+            handler.flush()
+            handler.close()
+        finally:
+            handler.release()
+        assert (tmp_path / "olala.log").read_text() == "olala\n"